@@ -1,10 +1,15 @@
 #!/usr/bin/env python
+import atexit
+import hmac
 import time
 import logging
+import logging.handlers
 import os
+import queue
+import tempfile
 
-from io import BytesIO
-from datetime import datetime, timedelta
+from collections import OrderedDict
+from urllib.parse import quote
 from dataclasses import dataclass
 
 import asyncio
@@ -12,7 +17,8 @@ import aiohttp
 import aiosqlite
 
 from pyrogram import Client
-from pyrogram.errors import FloodWait
+from pyrogram.errors import FloodWait, WebpageCurlFailed, WebpageMediaEmpty, MediaEmpty, ExternalUrlInvalid
+from pyrogram.types import Message
 
 from aiohttp import web
 
@@ -22,7 +28,19 @@ import argparse
 import random
 from dotenv import load_dotenv
 
-@dataclass
+try:
+    # risoluzione dns asincrona con c-ares invece del pool di thread di default
+    import aiodns
+except ImportError:
+    aiodns = None
+
+try:
+    # loop libuv, piu' veloce del loop asyncio di default (non disponibile su Windows)
+    import uvloop
+except ImportError:
+    uvloop = None
+
+@dataclass(slots=True, frozen=True)
 class TwitchClip:
     slug: str
     title: str
@@ -36,7 +54,7 @@ class TwitchClip:
 
 class TimestampFilter(logging.Filter):
     def filter(self, record):
-        record.timestamp = int(time.time())
+        record.timestamp = int(record.created)
         return True
 
 logging.getLogger('pyrogram').setLevel(logging.CRITICAL)
@@ -50,8 +68,14 @@ handler.setFormatter(formatter)
 
 handler.addFilter(TimestampFilter())
 
+# i log vengono solo accodati dal loop asyncio, la scrittura su stderr avviene nel thread del listener
+log_queue: queue.Queue = queue.Queue(-1)
+log_listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+log_listener.start()
+atexit.register(log_listener.stop)
+
 logger = logging.getLogger()
-logger.addHandler(handler)
+logger.addHandler(logging.handlers.QueueHandler(log_queue))
 logger.setLevel(logging.INFO)
 
 
@@ -79,12 +103,16 @@ def load_configs():
             "twitch_client_id": os.getenv("TWITCH_CLIENT_ID", ""),
             "twitch_client_secret": os.getenv("TWITCH_CLIENT_SECRET", ""),
             "clip_fetch_interval": int(os.getenv("CLIP_FETCH_INTERVAL", 120)),
+            "clips_queue_maxsize": int(os.getenv("CLIPS_QUEUE_MAXSIZE", 512)),
+            "telegram_queue_maxsize": int(os.getenv("TELEGRAM_QUEUE_MAXSIZE", 64)),
             "app_id": int(os.getenv("APP_ID", 0)),
             "app_hash": os.getenv("APP_HASH", ""),
             "session_name": os.getenv("SESSION_NAME", ""),
             "telegram_channel_name": os.getenv("TELEGRAM_CHANNEL_NAME", ""),
             "telegram_bot_token": os.getenv("TELEGRAM_BOT_TOKEN", ""),
             "target_chat_ids": list(map(int, os.getenv("TARGET_CHAT_IDS", "").split(","))),
+            "telegram_max_inflight_clips": int(os.getenv("TELEGRAM_MAX_INFLIGHT_CLIPS", 2)),
+            "telegram_max_concurrent_sends": int(os.getenv("TELEGRAM_MAX_CONCURRENT_SENDS", 4)),
             "enable_clip_server": os.getenv("ENABLE_CLIP_SERVER", "false").lower() == "true",
             "clip_server_host": os.getenv("CLIP_SERVER_HOST", "0.0.0.0"),
             "clip_server_port": int(os.getenv("CLIP_SERVER_PORT", 5000)),
@@ -100,44 +128,125 @@ def load_configs():
 CONFIGS = load_configs()
 
 # db parts
-async def init_clips_database():
-    async with aiosqlite.connect('database/clips.db') as db:
-        await db.execute('CREATE TABLE IF NOT EXISTS clips (slug TEXT PRIMARY KEY, title TEXT, url TEXT, created_at TEXT, durationSeconds INTEGER, curator_name TEXT, curator_url TEXT, thumbnail_url TEXT, mp4_url TEXT)')
-        await db.execute('CREATE TABLE IF NOT EXISTS blacklist_clips (slug TEXT PRIMARY KEY)')
-        
-        await db.execute('CREATE INDEX IF NOT EXISTS idx_clips_slug ON clips (slug)')
-        await db.execute('CREATE INDEX IF NOT EXISTS idx_blacklist_clips_slug ON blacklist_clips (slug)')
-        
-        await db.commit()
-
-async def add_clip_to_db(clip: TwitchClip, db: aiosqlite.Connection):
-    async with db.execute('INSERT OR IGNORE INTO clips VALUES (?,?,?,?,?,?,?,?,?)', (clip.slug, clip.title, clip.url, clip.created_at, clip.durationSeconds, clip.curator_name, clip.curator_url, clip.thumbnail_url, clip.mp4_url)) as cursor:
+INSERT_CLIP_SQL = 'INSERT OR IGNORE INTO clips VALUES (?,?,?,?,?,?,?,?,?) RETURNING slug'
+SELECT_CLIP_SLUG_SQL = 'SELECT slug FROM clips WHERE slug = ?'
+SELECT_CLIPS_ROWID_RANGE_SQL = 'SELECT MIN(rowid), MAX(rowid) FROM clips'
+SELECT_RANDOM_CLIP_SQL = 'SELECT c.slug, c.mp4_url, c.title FROM clips c LEFT JOIN blacklist_clips b ON b.slug = c.slug WHERE b.slug IS NULL AND c.rowid >= ? ORDER BY c.rowid LIMIT 1'
+SELECT_RECENT_SLUGS_SQL = 'SELECT slug FROM clips ORDER BY created_at DESC LIMIT ?'
+SELECT_BLACKLIST_SLUG_SQL = 'SELECT slug FROM blacklist_clips WHERE slug = ?'
+INSERT_BLACKLIST_SLUG_SQL = 'INSERT INTO blacklist_clips VALUES (?)'
+DELETE_BLACKLIST_SLUG_SQL = 'DELETE FROM blacklist_clips WHERE slug = ?'
+# CROSS JOIN fissa l'ordine del join: scansione della blacklist (piccola) e lookup per slug su clips
+SELECT_BLACKLISTED_CLIPS_SQL = 'SELECT slug, title, url FROM blacklist_clips CROSS JOIN clips USING (slug)'
+
+# le scritture (batch di clip e blacklist) condividono la connessione: una transazione alla volta,
+# le letture restano senza lock
+DB_WRITE_LOCK = asyncio.Lock()
+
+# range dei rowid della tabella clips, usato per estrarre una clip casuale senza ORDER BY RANDOM()
+CLIPS_ROWID_RANGE: dict = {'min': None, 'max': None}
+
+# cache LRU degli slug gia' salvati: a regime quasi tutte le clip di Helix sono gia' note
+RECENT_SLUGS_MAXSIZE = 10000
+RECENT_SLUGS: OrderedDict = OrderedDict()
+
+async def open_clips_database() -> aiosqlite.Connection:
+    # cached_statements: le query ripetute riusano lo statement gia' compilato da sqlite
+    # timeout: attesa massima (busy_timeout) su un lock prima di 'database is locked'
+    return await aiosqlite.connect('database/clips.db', timeout=5.0, cached_statements=256)
+
+async def init_clips_database(db: aiosqlite.Connection):
+    await db.execute('PRAGMA journal_mode=WAL')
+    await db.execute('PRAGMA synchronous=NORMAL')
+    await db.execute('PRAGMA temp_store=MEMORY')
+    await db.execute('PRAGMA mmap_size=134217728')
+    await db.execute('PRAGMA cache_size=-65536')
+
+    await db.execute('CREATE TABLE IF NOT EXISTS clips (slug TEXT PRIMARY KEY, title TEXT, url TEXT, created_at TEXT, durationSeconds INTEGER, curator_name TEXT, curator_url TEXT, thumbnail_url TEXT, mp4_url TEXT)')
+    await db.execute('CREATE TABLE IF NOT EXISTS blacklist_clips (slug TEXT PRIMARY KEY)')
+    
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_clips_slug ON clips (slug)')
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_blacklist_clips_slug ON blacklist_clips (slug)')
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_clips_created_at ON clips (created_at)')
+    
+    await db.commit()
+    # compatta il file all'avvio, prima che partano i task che lo usano
+    await db.execute('VACUUM')
+    # statistiche per il planner (sqlite_stat1), usate per scegliere gli indici nei join
+    await db.execute('ANALYZE')
+    await db.commit()
+
+async def add_clips_to_db(clips: list, db: aiosqlite.Connection) -> set:
+    """
+    Salva le clip in un'unica transazione e restituisce gli slug effettivamente inseriti
+    """
+    inserted_slugs: set = set()
+    # un'unica transazione per tutto il batch: un solo commit/fsync invece di uno per clip,
+    # sempre con lo stesso statement (gia' compilato nella cache) per ogni clip
+    async with DB_WRITE_LOCK:
+        for clip in clips:
+            async with db.execute(INSERT_CLIP_SQL, (clip.slug, clip.title, clip.url, clip.created_at, clip.durationSeconds, clip.curator_name, clip.curator_url, clip.thumbnail_url, clip.mp4_url)) as cursor:
+                row = await cursor.fetchone()
+            if row:
+                inserted_slugs.add(row[0])
         await db.commit()
+    return inserted_slugs
 
 async def check_if_clip_exists(slug: str, db: aiosqlite.Connection) -> bool:
-    async with db.execute('SELECT slug FROM clips WHERE slug = ?', (slug,)) as cursor:
+    async with db.execute(SELECT_CLIP_SLUG_SQL, (slug,)) as cursor:
         if await cursor.fetchone():
             return True
         return False
 
+def remember_slug(slug: str):
+    RECENT_SLUGS[slug] = None
+    RECENT_SLUGS.move_to_end(slug)
+    if len(RECENT_SLUGS) > RECENT_SLUGS_MAXSIZE:
+        RECENT_SLUGS.popitem(last=False)
+
+async def load_recent_slugs(db: aiosqlite.Connection):
+    async with db.execute(SELECT_RECENT_SLUGS_SQL, (RECENT_SLUGS_MAXSIZE,)) as cursor:
+        rows = await cursor.fetchall()
+    for (slug,) in reversed(rows):
+        remember_slug(slug)
+
+async def refresh_clips_rowid_range(db: aiosqlite.Connection):
+    async with db.execute(SELECT_CLIPS_ROWID_RANGE_SQL) as cursor:
+        CLIPS_ROWID_RANGE['min'], CLIPS_ROWID_RANGE['max'] = await cursor.fetchone()
+
+async def get_random_clip(db: aiosqlite.Connection) -> tuple | None:
+    min_rowid, max_rowid = CLIPS_ROWID_RANGE['min'], CLIPS_ROWID_RANGE['max']
+    if min_rowid is None:
+        return None
+    
+    async with db.execute(SELECT_RANDOM_CLIP_SQL, (random.randint(min_rowid, max_rowid),)) as cursor:
+        clip = await cursor.fetchone()
+    if clip is None:
+        # dopo il rowid estratto ci sono solo clip in blacklist, riparte dall'inizio
+        async with db.execute(SELECT_RANDOM_CLIP_SQL, (min_rowid,)) as cursor:
+            clip = await cursor.fetchone()
+    return clip
+
 async def check_if_clip_is_blacklisted(slug: str, db: aiosqlite.Connection) -> bool:
-    async with db.execute('SELECT slug FROM blacklist_clips WHERE slug = ?', (slug,)) as cursor:
+    async with db.execute(SELECT_BLACKLIST_SLUG_SQL, (slug,)) as cursor:
         if await cursor.fetchone():
             return True
         return False
     
 async def add_clip_to_blacklist(slug: str, db: aiosqlite.Connection):
-    if await check_if_clip_exists(slug, db) and not await check_if_clip_is_blacklisted(slug, db):
-        async with db.execute('INSERT INTO blacklist_clips VALUES (?)', (slug,)) as cursor:
-            await db.commit()
+    async with DB_WRITE_LOCK:
+        if await check_if_clip_exists(slug, db) and not await check_if_clip_is_blacklisted(slug, db):
+            async with db.execute(INSERT_BLACKLIST_SLUG_SQL, (slug,)) as cursor:
+                await db.commit()
         
 async def remove_clip_from_blacklist(slug: str, db: aiosqlite.Connection):
-    if await check_if_clip_exists(slug, db) and await check_if_clip_is_blacklisted(slug, db):
-        async with db.execute('DELETE FROM blacklist_clips WHERE slug = ?', (slug,)) as cursor:
-            await db.commit()
+    async with DB_WRITE_LOCK:
+        if await check_if_clip_exists(slug, db) and await check_if_clip_is_blacklisted(slug, db):
+            async with db.execute(DELETE_BLACKLIST_SLUG_SQL, (slug,)) as cursor:
+                await db.commit()
         
 async def get_blacklisted_clips(db: aiosqlite.Connection) -> list:
-    async with db.execute('SELECT slug,title, url FROM clips WHERE slug IN (SELECT slug FROM blacklist_clips)') as cursor:
+    async with db.execute(SELECT_BLACKLISTED_CLIPS_SQL) as cursor:
         return await cursor.fetchall()
     
 
@@ -148,217 +257,462 @@ def get_oauth_headers(auth_token: str, client_id: str) -> dict:
         'Client-Id': client_id,
     }
 
+def create_aiohttp_session(timeout: aiohttp.ClientTimeout | None = None) -> aiohttp.ClientSession:
+    # connessioni keep-alive e cache dns condivise da tutte le richieste della sessione
+    connector: aiohttp.TCPConnector = aiohttp.TCPConnector(
+        resolver=aiohttp.AsyncResolver() if aiodns is not None else None,
+        limit=64,
+        limit_per_host=16,
+        ttl_dns_cache=600,
+        keepalive_timeout=75,
+        enable_cleanup_closed=True,
+    )
+    if timeout is None:
+        return aiohttp.ClientSession(connector=connector)
+    return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+API_REQUEST_TIMEOUT = 30  # Timeout in secondi per le chiamate alle API Twitch
 MAX_RETRIES = 3  # Numero massimo di tentativi
-RETRY_DELAY = 2  # Ritardo in secondi tra i tentativi
+RETRY_DELAY = 2  # Ritardo in secondi tra i tentativi (base del backoff esponenziale)
+RETRY_STATUSES = {429, 500, 502, 503, 504}  # Errori temporanei per cui ha senso ritentare
 
-async def get_twitch_bearer() -> tuple:
-    retries = 0
-    while retries < MAX_RETRIES:
+def get_retry_delay(response: aiohttp.ClientResponse, attempt: int) -> float:
+    # Retry-After (standard) o Ratelimit-Reset (timestamp usato da Twitch), altrimenti backoff esponenziale
+    try:
+        if 'Retry-After' in response.headers:
+            return max(0.0, float(response.headers['Retry-After']))
+        if 'Ratelimit-Reset' in response.headers:
+            return max(0.0, float(response.headers['Ratelimit-Reset']) - time.time())
+    except ValueError:
+        pass
+    return RETRY_DELAY ** attempt
+
+async def request_with_retry(aiohttp_session: aiohttp.ClientSession, method: str, url: str, **kwargs) -> aiohttp.ClientResponse:
+    """
+    Esegue una richiesta ritentando con backoff sugli errori temporanei (429, 5xx, errori di rete).
+    Solleva aiohttp.ClientResponseError sugli altri errori; la risposta restituita va chiusa dal chiamante
+    """
+    for attempt in range(1, MAX_RETRIES + 1):
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post("https://id.twitch.tv/oauth2/token", data={
-                    "client_id": CONFIGS['twitch_client_id'],
-                    "client_secret": CONFIGS['twitch_client_secret'],
-                    "grant_type": "client_credentials"
-                }) as response:
-                    if response.status == 200:
-                        response_json = await response.json()
-                        return (response_json["access_token"], response_json["expires_in"])
-                    else:
-                        logging.error(f"Failed to fetch token, status code: {response.status}")
-        except Exception as e:
-            logging.error(f"Exception during request: {e}")
-        
-        retries += 1
-        if retries < MAX_RETRIES:
-            logging.info(f"Retrying... ({retries}/{MAX_RETRIES})")
-            await asyncio.sleep(RETRY_DELAY)
-    
-    logging.error("Max retries reached. Unable to fetch Twitch bearer token.")
-    return (None, None)
+            response: aiohttp.ClientResponse = await aiohttp_session.request(method, url, **kwargs)
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            if attempt == MAX_RETRIES:
+                raise
+            delay: float = RETRY_DELAY ** attempt
+            logging.warning("Request to %s failed (%s), retrying in %s seconds (%s/%s)", url, e, delay, attempt, MAX_RETRIES)
+        else:
+            if response.status not in RETRY_STATUSES or attempt == MAX_RETRIES:
+                response.raise_for_status()
+                return response
+            delay = get_retry_delay(response, attempt)
+            response.release()
+            logging.warning("Request to %s returned %s, retrying in %s seconds (%s/%s)", url, response.status, delay, attempt, MAX_RETRIES)
+        await asyncio.sleep(delay)
+
+async def get_twitch_bearer(aiohttp_session: aiohttp.ClientSession) -> tuple:
+    try:
+        response: aiohttp.ClientResponse = await request_with_retry(aiohttp_session, 'POST', "https://id.twitch.tv/oauth2/token", data={
+            "client_id": CONFIGS['twitch_client_id'],
+            "client_secret": CONFIGS['twitch_client_secret'],
+            "grant_type": "client_credentials"
+        })
+        async with response:
+            response_json = orjson.loads(await response.read())
+            return (response_json["access_token"], response_json["expires_in"])
+    except Exception as e:
+        logging.error(f"Unable to fetch Twitch bearer token: {e}")
+        return (None, None)
            
 # clips part
-async def fetch_clips(clips_queue: asyncio.Queue, aiohttp_session: aiohttp.ClientSession):
-    oauth_token: str = await get_twitch_bearer()
-    oauth_headers: dict = get_oauth_headers(oauth_token[0], CONFIGS['twitch_client_id'])
-    expiring_date: datetime = datetime.now() + timedelta(seconds=oauth_token[1])
-    logging.info(f"Bearer token: {oauth_token[0]} - Expires at: {expiring_date} - Expires in: {oauth_token[1]} seconds")
+async def get_clips_page(aiohttp_session: aiohttp.ClientSession, twitch_auth: dict, start_date: str, end_date: str, cursor: str) -> dict:
+    params = {
+        'broadcaster_id': CONFIGS['broadcaster_id'],
+        'after': cursor,
+        'started_at': start_date,
+        'ended_at': end_date,
+        'first': 100,
+        'is_featured': 'false',
+    }
+    response: aiohttp.ClientResponse = await request_with_retry(aiohttp_session, 'GET', 'https://api.twitch.tv/helix/clips', params=params, headers=twitch_auth['headers'])
+    async with response:
+        return orjson.loads(await response.read())
+
+TOKEN_REFRESH_RATIO = 0.9  # Il token viene rinnovato al 90% della sua durata
+
+async def renew_twitch_auth(aiohttp_session: aiohttp.ClientSession, twitch_auth: dict) -> bool:
+    oauth_token: tuple = await get_twitch_bearer(aiohttp_session)
+    if oauth_token[0] is None:
+        return False
     
+    twitch_auth['headers'] = get_oauth_headers(oauth_token[0], CONFIGS['twitch_client_id'])
+    twitch_auth['expires_in'] = oauth_token[1]
+    twitch_auth['ready'].set()
+    logging.info(f"Bearer token: {oauth_token[0]} - Expires in: {oauth_token[1]} seconds")
+    return True
+
+async def refresh_twitch_token(aiohttp_session: aiohttp.ClientSession, twitch_auth: dict):
+    # rinnovo proattivo: fetch_clips legge sempre gli header aggiornati da twitch_auth
     while True:
-        if expiring_date < datetime.now():
-            oauth_token = await get_twitch_bearer()
-            logging.info(f"Renewing bearer token! New token: {oauth_token[0]}")
-            expiring_date = datetime.now() + timedelta(seconds=oauth_token[1])
-            
+        if await renew_twitch_auth(aiohttp_session, twitch_auth):
+            await asyncio.sleep(twitch_auth['expires_in'] * TOKEN_REFRESH_RATIO)
+        else:
+            await asyncio.sleep(RETRY_DELAY ** MAX_RETRIES)
+
+THUMBNAIL_SUFFIX = '-preview-480x272.jpg'
+HELIX_DATE_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+CLIPS_WINDOW_SECONDS = 60 * 24 * 60 * 60  # Le clip vengono cercate negli ultimi 60 giorni
+
+def get_clip_mp4_url(thumbnail_url: str) -> str:
+    # l'mp4 ha lo stesso url della thumbnail senza il suffisso di anteprima, basta tagliarlo
+    if thumbnail_url.endswith(THUMBNAIL_SUFFIX):
+        return thumbnail_url[:-len(THUMBNAIL_SUFFIX)] + '.mp4'
+    return thumbnail_url
+
+async def fetch_clips(clips_queue: asyncio.Queue, aiohttp_session: aiohttp.ClientSession, twitch_auth: dict):
+    while True:
+        await twitch_auth['ready'].wait()
+        
         cursor: str = ""
-        start_date: str = (datetime.now() - timedelta(days=60)).strftime('%Y-%m-%dT%H:%M:%SZ')
+        # finestra di date calcolata una volta per ciclo, in UTC come richiesto da Helix
+        now: float = time.time()
+        start_date: str = time.strftime(HELIX_DATE_FORMAT, time.gmtime(now - CLIPS_WINDOW_SECONDS))
+        end_date: str = time.strftime(HELIX_DATE_FORMAT, time.gmtime(now))
         
+        token_renewed: bool = False
+        
+        # la pagina successiva viene richiesta mentre si accodano le clip di quella corrente
+        next_page: asyncio.Task = asyncio.create_task(get_clips_page(aiohttp_session, twitch_auth, start_date, end_date, cursor))
         try:
             while True:
-                params = {
-                    'broadcaster_id': CONFIGS['broadcaster_id'],
-                    'after': cursor,
-                    'started_at': start_date,
-                    'ended_at': datetime.now().strftime('%Y-%m-%dT%H:%M:%SZ'),
-                    'first': 100,
-                    'is_featured': 'false',
-                }
                 try:
-                    async with aiohttp_session.get('https://api.twitch.tv/helix/clips', params=params, headers=oauth_headers) as response:
-                        
-                        if response.status == 200:
-                            data = await response.json()
-                            clips = data['data']
-
-                            if not clips:
-                                logging.info("No clips found for this cycle")
-                                break
-
-                            for clip in clips:
-                                await clips_queue.put(TwitchClip(
-                                    clip['id'],
-                                    clip['title'],
-                                    clip['url'],
-                                    clip['created_at'],
-                                    clip['duration'],
-                                    clip['creator_name'],
-                                    f"https://www.twitch.tv/{clip['creator_name']}",
-                                    clip['thumbnail_url'],
-                                    clip['thumbnail_url'].replace('-preview-480x272.jpg', '.mp4')
-                                ))
-                                
-                            cursor = data.get('pagination', {}).get('cursor', "")
-                            
-                            if not cursor:
-                                break
-                        else:
-                            logging.info(f"Error: {response.status}")
-                            continue
-                except Exception as e:
-                    logging.error(f"Error: {e}")
+                    data: dict = await next_page
+                except aiohttp.ClientResponseError as e:
+                    if e.status != 401 or token_renewed:
+                        raise
+                    # token revocato o scaduto: si rinnova una volta e si ritenta la stessa pagina
+                    token_renewed = True
+                    logging.info("Renewing bearer token after 401")
+                    await renew_twitch_auth(aiohttp_session, twitch_auth)
+                    next_page = asyncio.create_task(get_clips_page(aiohttp_session, twitch_auth, start_date, end_date, cursor))
                     continue
+                
+                clips = data['data']
+                if not clips:
+                    logging.info("No clips found for this cycle")
+                    break
+                
+                cursor = data.get('pagination', {}).get('cursor', "")
+                if cursor:
+                    next_page = asyncio.create_task(get_clips_page(aiohttp_session, twitch_auth, start_date, end_date, cursor))
+
+                for clip in clips:
+                    await clips_queue.put(TwitchClip(
+                        clip['id'],
+                        clip['title'],
+                        clip['url'],
+                        clip['created_at'],
+                        clip['duration'],
+                        clip['creator_name'],
+                        f"https://www.twitch.tv/{clip['creator_name']}",
+                        clip['thumbnail_url'],
+                        get_clip_mp4_url(clip['thumbnail_url'])
+                    ))
+                    
+                if not cursor:
+                    break
+        except Exception as e:
+            logging.error(f"Error: {e}")
         finally:
+            if not next_page.done():
+                next_page.cancel()
             logging.info(f"Cycle ended! Sleeping for {CONFIGS['clip_fetch_interval']} seconds")
             await asyncio.sleep(CONFIGS['clip_fetch_interval'])
                 
-async def process_clips_queue(clips_queue: asyncio.Queue, telegram_queue: asyncio.Queue, database_instance: aiosqlite.Connection):
-    while True:
-        clip = await clips_queue.get()
+CLIPS_BATCH_SIZE = 200  # Numero massimo di clip salvate in una singola transazione
+CLIPS_BATCH_WINDOW = 0.2  # Secondi di attesa massima per riempire un batch
+
+async def get_clips_batch(clips_queue: asyncio.Queue) -> list:
+    batch: list = [await clips_queue.get()]
+    deadline: float = asyncio.get_running_loop().time() + CLIPS_BATCH_WINDOW
+    while len(batch) < CLIPS_BATCH_SIZE:
+        if not clips_queue.empty():
+            batch.append(clips_queue.get_nowait())
+            continue
+        timeout: float = deadline - asyncio.get_running_loop().time()
+        if timeout <= 0:
+            break
+        try:
+            batch.append(await asyncio.wait_for(clips_queue.get(), timeout))
+        except asyncio.TimeoutError:
+            break
+    return batch
+
+async def store_clips_batch(batch: list, telegram_queue: asyncio.Queue, database_instance: aiosqlite.Connection):
+    # dict per slug: la stessa clip puo' comparire piu' volte nel batch (pagine Helix sovrapposte)
+    clips: dict = {}
+    for clip in batch:
         if isinstance(clip, TwitchClip):
-            if clip.mp4_url.endswith('.mp4'):
-                if not await check_if_clip_exists(clip.slug, database_instance):
-                    await add_clip_to_db(clip, database_instance)
-                    await telegram_queue.put(clip)
+            if clip.slug in RECENT_SLUGS:
+                RECENT_SLUGS.move_to_end(clip.slug)
+            elif clip.mp4_url.endswith('.mp4'):
+                clips.setdefault(clip.slug, clip)
             else:
-                logging.error(f"Clip {clip.slug} is not a mp4 file and is broken. Skipping... ({clip.mp4_url})")
+                logging.error("Clip %s is not a mp4 file and is broken. Skipping... (%s)", clip.slug, clip.mp4_url)
+                
+    if not clips:
+        return
+    
+    # INSERT OR IGNORE scarta gia' le clip presenti: RETURNING restituisce solo quelle nuove
+    inserted_slugs: set = await add_clips_to_db(list(clips.values()), database_instance)
+    for slug in clips:
+        remember_slug(slug)
+    
+    if inserted_slugs:
+        await refresh_clips_rowid_range(database_instance)
+        for slug, clip in clips.items():
+            if slug in inserted_slugs:
+                await telegram_queue.put(clip)
 
-async def send_clip_to_telegram(clip: TwitchClip, aiohttp_session: aiohttp.ClientSession, pyro_instance: Client, target_chat_id: int):
-    share_clip_url = f"https://t.me/share/url?url={clip.url}"
-    share_channel_url = f"https://t.me/share/url?url=t.me/{CONFIGS['telegram_channel_name']}&text=Scopri altre fantastiche clip su @{CONFIGS['telegram_channel_name']}!"
-    share_channel_url = share_channel_url.replace(' ', '%20')
-    caption = f"⚡️ <b>{clip.title}</b>\n\nGrazie a <a href='{clip.curator_url}'>{clip.curator_name}</a> per aver condiviso questa <b>clip!</b> 🔗\n\n<a href='{clip.url}'>📺 Guarda la clip su <b>Twitch</b></a>\n👉 <b>Iscriviti</b> al canale <b><a href='https://twitch.tv/{CONFIGS['broadcaster_name']}'>Twitch</a></b> per vedere le clip in <b>diretta</b>!\n\n🔗 <b><a href='{share_clip_url}'>Condividi la clip su Telegram</a></b>\n<b>⏩ <a href='{share_channel_url}'>Condividi il canale su Telegram</a></b>\n"
-        
-    async with aiohttp_session.get(clip.mp4_url) as response:
-        if response.status == 200:
-            video = BytesIO(await response.read())
-            video.name = f"{clip.slug}.mp4"
-            video.seek(0)
+async def process_clips_queue(clips_queue: asyncio.Queue, telegram_queue: asyncio.Queue, database_instance: aiosqlite.Connection):
+    while True:
+        batch: list = await get_clips_batch(clips_queue)
+        try:
+            await store_clips_batch(batch, telegram_queue, database_instance)
+        finally:
+            for _ in batch:
+                clips_queue.task_done()
+
+DOWNLOAD_CHUNK_SIZE = 1 << 16  # 64 KiB
+
+async def download_clip(clip: TwitchClip, aiohttp_session: aiohttp.ClientSession) -> str | None:
+    """
+    Scarica l'mp4 della clip a blocchi in un file temporaneo e ne restituisce il percorso
+    """
+    try:
+        response: aiohttp.ClientResponse = await request_with_retry(aiohttp_session, 'GET', clip.mp4_url)
+    except aiohttp.ClientResponseError as e:
+        logging.error("Error downloading clip: %s - %s - %s", e.status, clip.mp4_url, clip.slug)
+        return None
+    
+    async with response:
+        with tempfile.NamedTemporaryFile(suffix='.mp4', delete=False) as video:
             try:
-                await pyro_instance.send_video(
-                    chat_id=target_chat_id,
-                    caption=caption,
-                    video=video,
-                )
-                logging.info(f"Clip {clip.slug} was sent to telegram successfully!")
-                
-            except FloodWait as e:
-                logging.error(f"Error during sending clip to telegram due to floodwait! waiting for {e.value} seconds before retrying")
-                await asyncio.sleep(e.value)
-                await pyro_instance.send_video(
-                    chat_id=target_chat_id,
-                    caption=caption,
-                    video=video,
-                    thumb=clip.thumbnail_url,
-                    disable_notification=True,
-                    supports_streaming=True,
-                )
-                
-            except Exception as e:
-                logging.error(f"Error during sending clip to telegram: {e}")
-        else:
-            logging.error(f"Error downloading clip: {response.status} - {clip.mp4_url} - {clip.slug}")
+                async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                    video.write(chunk)
+            except BaseException:
+                video.close()
+                os.remove(video.name)
+                raise
+        return video.name
+
+# parti statiche della caption calcolate una sola volta
+BROADCASTER_URL = f"https://twitch.tv/{CONFIGS['broadcaster_name']}"
+SHARE_CHANNEL_URL = f"https://t.me/share/url?url=t.me/{CONFIGS['telegram_channel_name']}&text=" + quote(f"Scopri altre fantastiche clip su @{CONFIGS['telegram_channel_name']}!", safe='@!')
+CAPTION_TEMPLATE = "⚡️ <b>{title}</b>\n\nGrazie a <a href='{curator_url}'>{curator_name}</a> per aver condiviso questa <b>clip!</b> 🔗\n\n<a href='{url}'>📺 Guarda la clip su <b>Twitch</b></a>\n👉 <b>Iscriviti</b> al canale <b><a href='{broadcaster_url}'>Twitch</a></b> per vedere le clip in <b>diretta</b>!\n\n🔗 <b><a href='{share_clip_url}'>Condividi la clip su Telegram</a></b>\n<b>⏩ <a href='{share_channel_url}'>Condividi il canale su Telegram</a></b>\n"
+
+def build_clip_caption(clip: TwitchClip) -> str:
+    return CAPTION_TEMPLATE.format(
+        title=clip.title,
+        curator_url=clip.curator_url,
+        curator_name=clip.curator_name,
+        url=clip.url,
+        broadcaster_url=BROADCASTER_URL,
+        share_clip_url=f"https://t.me/share/url?url={clip.url}",
+        share_channel_url=SHARE_CHANNEL_URL,
+    )
+
+# limite globale di send_video contemporanei, per restare entro i rate limit di telegram
+TELEGRAM_SEND_SEMAPHORE = asyncio.Semaphore(CONFIGS['telegram_max_concurrent_sends'])
+
+async def send_clip_to_telegram(clip: TwitchClip, caption: str, video: str, pyro_instance: Client, target_chat_id: int, cached: bool = False) -> Message:
+    """
+    Invia la clip a una chat; video puo' essere l'url dell'mp4 (scaricato da telegram), il percorso di un file locale
+    o, con cached=True, il file_id di un media gia' su telegram (video, animation o document)
+    """
+    async def send() -> Message:
+        if cached:
+            # send_cached_media accetta il file_id di qualsiasi tipo di media, send_video solo quello di un video
+            return await pyro_instance.send_cached_media(chat_id=target_chat_id, file_id=video, caption=caption)
+        return await pyro_instance.send_video(
+            chat_id=target_chat_id,
+            caption=caption,
+            video=video,
+            file_name=f"{clip.slug}.mp4",
+            supports_streaming=True,
+        )
+    
+    async with TELEGRAM_SEND_SEMAPHORE:
+        try:
+            message: Message = await send()
+        except FloodWait as e:
+            # il semaforo resta occupato durante l'attesa: rallentano anche gli altri invii
+            logging.error(f"Error during sending clip to telegram due to floodwait! waiting for {e.value} seconds before retrying")
+            await asyncio.sleep(e.value)
+            message = await send()
+    logging.info("Clip %s was sent to telegram successfully!", clip.slug)
+    return message
+
+def get_message_file_id(message: Message) -> str | None:
+    # con l'invio per url e' telegram a scegliere il tipo di media, non sempre e' un video
+    media = message.video or message.animation or message.document
+    if media is None:
+        return None
+    return media.file_id
+
+# errori con cui telegram segnala di non essere riuscito a scaricare l'mp4 dall'url
+URL_FETCH_ERRORS = (WebpageCurlFailed, WebpageMediaEmpty, MediaEmpty, ExternalUrlInvalid)
+
+async def upload_clip_to_telegram(clip: TwitchClip, caption: str, aiohttp_session: aiohttp.ClientSession, pyro_instance: Client, target_chat_id: int) -> Message | None:
+    """
+    Carica la clip su una chat e restituisce il messaggio inviato, None se l'mp4 non e' scaricabile
+    """
+    try:
+        # prima si prova a far scaricare l'mp4 direttamente a telegram, senza passare da qui
+        message: Message = await send_clip_to_telegram(clip, caption, clip.mp4_url, pyro_instance, target_chat_id)
+    except URL_FETCH_ERRORS as e:
+        # solo se telegram non e' riuscito a scaricare l'url: gli altri errori (floodwait, chat non valida,
+        # timeout con invio magari gia' avvenuto) non si risolvono ricaricando il file
+        logging.info("Telegram could not fetch clip %s by url, uploading it (%s)", clip.slug, e)
+        video_path: str | None = await download_clip(clip, aiohttp_session)
+        if video_path is None:
+            return None
+        try:
+            message = await send_clip_to_telegram(clip, caption, video_path, pyro_instance, target_chat_id)
+        finally:
+            os.remove(video_path)
+    return message
+        
+async def send_clip_to_chats(clip: TwitchClip, aiohttp_session: aiohttp.ClientSession, pyro_instance: Client):
+    caption: str = build_clip_caption(clip)
+    target_chat_ids: list = list(CONFIGS['target_chat_ids'])
+    
+    # la clip viene caricata una sola volta, le altre chat ricevono il file_id gia' presente su telegram
+    file_id: str | None = None
+    while target_chat_ids and file_id is None:
+        target_chat_id: int = target_chat_ids.pop(0)
+        try:
+            message: Message | None = await upload_clip_to_telegram(clip, caption, aiohttp_session, pyro_instance, target_chat_id)
+        except Exception as e:
+            logging.error(f"Error during sending clip {clip.slug} to telegram: {e}")
+            continue
+        if message is None:
+            return
+        # clip consegnata; se il messaggio non ha un file_id riutilizzabile la prossima chat ricarica di nuovo la clip
+        file_id = get_message_file_id(message)
+        
+    if file_id is None or not target_chat_ids:
+        return
+    
+    results: list = await asyncio.gather(
+        *[send_clip_to_telegram(clip, caption, file_id, pyro_instance, target_chat_id, cached=True) for target_chat_id in target_chat_ids],
+        return_exceptions=True,
+    )
+    for result in results:
+        if isinstance(result, Exception):
+            logging.error(f"Error during sending clip {clip.slug} to telegram: {result}")
             
 async def process_telegram_queue(telegram_queue: asyncio.Queue, aiohttp_session: aiohttp.ClientSession, pyro_instance: Client):
+    # start() ritorna solo a client inizializzato e connesso, non serve attendere oltre
     await pyro_instance.start()
     
-    while not pyro_instance.is_initialized:
-        logging.info("Waiting for pyrogram to initialize")
-        await asyncio.sleep(1)
+    inflight_clips: asyncio.Semaphore = asyncio.Semaphore(CONFIGS['telegram_max_inflight_clips'])
+    pending_tasks: set = set()
+    
+    async def process_clip(clip: TwitchClip):
+        try:
+            await send_clip_to_chats(clip, aiohttp_session, pyro_instance)
+        except Exception as e:
+            logging.error(f"Error during processing clip {clip.slug}: {e}")
+        finally:
+            inflight_clips.release()
+            telegram_queue.task_done()
         
     while True:
         clip = await telegram_queue.get()
         if isinstance(clip, TwitchClip):
-            for target_chat_id in CONFIGS['target_chat_ids']:
-                await send_clip_to_telegram(clip, aiohttp_session, pyro_instance, target_chat_id)
+            await inflight_clips.acquire()
+            task: asyncio.Task = asyncio.create_task(process_clip(clip))
+            pending_tasks.add(task)
+            task.add_done_callback(pending_tasks.discard)
+        else:
+            telegram_queue.task_done()
+
+async def log_queues_size(clips_queue: asyncio.Queue, telegram_queue: asyncio.Queue):
+    while True:
+        await asyncio.sleep(CONFIGS['clip_fetch_interval'])
+        logging.info(f"Queues size - clips: {clips_queue.qsize()}/{clips_queue.maxsize} - telegram: {telegram_queue.qsize()}/{telegram_queue.maxsize}")
 
 # clip server part
+def orjson_response(data: dict, status: int = 200) -> web.Response:
+    return web.Response(body=orjson.dumps(data), status=status, content_type='application/json')
+
+# endpoint della blacklist, protetti da webserver_secret_token
+AUTH_ROUTES = {'/get_blacklisted_clips', '/add_to_blacklist', '/remove_from_blacklist'}
+
+@web.middleware
+async def auth_middleware(request: web.Request, handler) -> web.StreamResponse:
+    if request.path in AUTH_ROUTES:
+        # senza un token configurato gli endpoint restano chiusi, altrimenti '' == '' lascerebbe passare tutti
+        secret_token: str = CONFIGS['webserver_secret_token']
+        # confronto a tempo costante, non rivela quanti caratteri del token sono corretti
+        token: str = request.query.get('webserver_secret_token', '')
+        if not secret_token or not hmac.compare_digest(token.encode(), secret_token.encode()):
+            return orjson_response({'error': 'Unauthorized'}, status=401)
+    return await handler(request)
+
 async def run_clip_server(database_instance: aiosqlite.Connection, host: str, port: int):
         
     async def handle_clip_request(request):
-        async with database_instance.execute('SELECT slug, mp4_url, title FROM clips WHERE slug NOT IN (SELECT slug FROM blacklist_clips) ORDER BY RANDOM() LIMIT 1') as cursor:
-            clip = await cursor.fetchone()
-            if clip:
-                slug, mp4_url, title = clip
-                return web.json_response({'slug': slug, 'mp4_url': mp4_url, 'title': title})
-            else:
-                return web.json_response({'error': 'No clips found'}, status=404)
+        clip = await get_random_clip(database_instance)
+        if clip:
+            slug, mp4_url, title = clip
+            return orjson_response({'slug': slug, 'mp4_url': mp4_url, 'title': title})
+        else:
+            return orjson_response({'error': 'No clips found'}, status=404)
 
+    with open('src/static/index.html', 'r') as index_file:
+        index_template: str = index_file.read()
+    # una pagina gia' renderizzata per ogni immagine di caricamento, servita cosi' com'e'
+    index_pages: list = [index_template.replace('[PICTURE_LOAD_HERE]', picture).encode('utf-8') for picture in CONFIGS['loading_video_pictures']]
+    
     async def handle_index_request(request):
-        html_content: str = open('src/static/index.html', 'r').read().replace('[PICTURE_LOAD_HERE]', random.choice(CONFIGS['loading_video_pictures']))
-        return web.Response(text=html_content, content_type='text/html')
+        return web.Response(body=random.choice(index_pages), content_type='text/html', charset='utf-8')
 
     async def get_blacklist_clips(request):
         try:
-            if request.method == 'GET' and request.query.get('webserver_secret_token') == CONFIGS['webserver_secret_token']:
-                blacklisted_clips = await get_blacklisted_clips(database_instance)
-                for i, clip in enumerate(blacklisted_clips):
-                    blacklisted_clips[i] = {'slug': clip[0], 'title': clip[1], 'url': clip[2]}
-                return web.json_response({'blacklisted_clips': blacklisted_clips})
-            else:
-                return web.json_response({'error': 'Unauthorized'}, status=401)
+            blacklisted_clips: list = await get_blacklisted_clips(database_instance)
+            return orjson_response({'blacklisted_clips': [{'slug': slug, 'title': title, 'url': url} for slug, title, url in blacklisted_clips]})
         except Exception as e:
             logging.error(f"Error: {e} - {request} - {request.query} - {request.headers}")
-            return web.json_response({'error': 'Internal server error'}, status=500)
+            return orjson_response({'error': 'Internal server error'}, status=500)
         
     async def add_to_blacklist(request):
         try:
-            if request.method == 'POST' and request.query.get('webserver_secret_token') == CONFIGS['webserver_secret_token']:
-                data: dict = await request.json()
-                slug: str = data.get('slug')
-                if slug:
-                    await add_clip_to_blacklist(slug, database_instance)
-                    return web.json_response({'status': 'success'})
-                else:
-                    return web.json_response({'error': 'No slug provided'}, status=400)
+            data: dict = orjson.loads(await request.read())
+            slug: str = data.get('slug')
+            if slug:
+                await add_clip_to_blacklist(slug, database_instance)
+                return orjson_response({'status': 'success'})
+            else:
+                return orjson_response({'error': 'No slug provided'}, status=400)
         except Exception as e:
             logging.error(f"Error: {e} - {request} - {request.query} - {request.headers}")
-            return web.json_response({'error': 'Internal server error'}, status=500)
+            return orjson_response({'error': 'Internal server error'}, status=500)
             
     async def remove_from_blacklist(request):
         try:
-            if request.method == 'POST' and request.query.get('webserver_secret_token') == CONFIGS['webserver_secret_token']:
-                data: dict = await request.json()
-                slug: str = data.get('slug')
-                if slug:
-                    await remove_clip_from_blacklist(slug, database_instance)
-                    return web.json_response({'status': 'success'})
-                else:
-                    return web.json_response({'error': 'No slug provided'}, status=400)
+            data: dict = orjson.loads(await request.read())
+            slug: str = data.get('slug')
+            if slug:
+                await remove_clip_from_blacklist(slug, database_instance)
+                return orjson_response({'status': 'success'})
+            else:
+                return orjson_response({'error': 'No slug provided'}, status=400)
         except Exception as e:
             logging.error(f"Error: {e} - {request} - {request.query} - {request.headers}")
-            return web.json_response({'error': 'Internal server error'}, status=500)
+            return orjson_response({'error': 'Internal server error'}, status=500)
 
-    app = web.Application()
+    app = web.Application(middlewares=[auth_middleware])
     app.add_routes([web.get('/clip', handle_clip_request)])
     app.add_routes([web.get('/', handle_index_request)])
 
@@ -375,7 +729,11 @@ async def run_clip_server(database_instance: aiosqlite.Connection, host: str, po
                 
     
 async def main():
-    await init_clips_database()
+    database_instance: aiosqlite.Connection = await open_clips_database()
+    await init_clips_database(database_instance)
+    await refresh_clips_rowid_range(database_instance)
+    await load_recent_slugs(database_instance)
+    
     pyro_instance: Client = Client(
         name=CONFIGS['session_name'],
         api_id=CONFIGS['app_id'],
@@ -384,16 +742,22 @@ async def main():
     )
         
     tasks: asyncio.Task = []
-    clips_queue: asyncio.Queue = asyncio.Queue()
-    telegram_queue: asyncio.Queue = asyncio.Queue()
+    # code limitate: quando sono piene i producer si fermano sul put (back-pressure)
+    clips_queue: asyncio.Queue = asyncio.Queue(maxsize=CONFIGS['clips_queue_maxsize'])
+    telegram_queue: asyncio.Queue = asyncio.Queue(maxsize=CONFIGS['telegram_queue_maxsize'])
     
-    aiohttp_session: aiohttp.ClientSession = aiohttp.ClientSession()
+    # sessioni separate: i download degli mp4 non tolgono connessioni alle chiamate Helix
+    api_session: aiohttp.ClientSession = create_aiohttp_session(timeout=aiohttp.ClientTimeout(total=API_REQUEST_TIMEOUT))
+    download_session: aiohttp.ClientSession = create_aiohttp_session()
     
-    database_instance: aiosqlite.Connection = await aiosqlite.connect("database/clips.db")
+    # header oauth condivisi tra il task che rinnova il token e fetch_clips
+    twitch_auth: dict = {'headers': None, 'expires_in': None, 'ready': asyncio.Event()}
     
-    tasks.append(asyncio.create_task(fetch_clips(clips_queue, aiohttp_session)))
+    tasks.append(asyncio.create_task(refresh_twitch_token(api_session, twitch_auth)))
+    tasks.append(asyncio.create_task(fetch_clips(clips_queue, api_session, twitch_auth)))
     tasks.append(asyncio.create_task(process_clips_queue(clips_queue, telegram_queue, database_instance)))
-    tasks.append(asyncio.create_task(process_telegram_queue(telegram_queue, aiohttp_session, pyro_instance)))
+    tasks.append(asyncio.create_task(process_telegram_queue(telegram_queue, download_session, pyro_instance)))
+    tasks.append(asyncio.create_task(log_queues_size(clips_queue, telegram_queue)))
                  
     if CONFIGS['enable_clip_server'] and os.path.exists('src/static/index.html'):
         tasks.append(asyncio.create_task(run_clip_server(database_instance, CONFIGS['clip_server_host'], CONFIGS['clip_server_port'])))
@@ -403,7 +767,10 @@ async def main():
     await asyncio.gather(*tasks)
     
 if __name__ == '__main__':
-    asyncio.run(main())
+    if uvloop is not None:
+        uvloop.run(main())
+    else:
+        asyncio.run(main())
     
     
 